@@ -1,18 +1,56 @@
+import asyncio
+import cProfile
+import functools
+import inspect
+import io
 import json
+import mmap
 import os
 import pathlib
+import pstats
+import random
 import re
 import shutil
 import sqlite3
+import struct
 import sys
-from collections import defaultdict
+import tempfile
+import time
+import tracemalloc
+import zlib
+from collections import defaultdict, deque
 from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from getpass import getpass
-from typing import Any, Callable, Dict, Hashable, Iterator, List, Tuple, Optional
-
-import requests  # type: ignore
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    BinaryIO,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    TextIO,
+    Tuple,
+    TypeVar,
+    Optional,
+    Set,
+    Union,
+    cast,
+)
+from urllib.parse import urljoin, urlsplit
+
+import aiohttp
 import typer
 import vk_api as vk  # type: ignore
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from vk_api import audio as vk_audio_api
 
 DEBUG = False
@@ -51,6 +89,137 @@ class LLog:
 llog = LLog
 
 
+# profiling helpers
+F = TypeVar("F", bound=Callable[..., Any])
+T = TypeVar("T")
+timings: Dict[str, Dict[str, float]] = defaultdict(
+    lambda: {"calls": 0, "total": 0.0, "max": 0.0}
+)
+
+
+def record_timing(name: str, elapsed: float, calls: int = 1) -> None:
+    entry = timings[name]
+    entry["calls"] += calls
+    entry["total"] += elapsed
+    entry["max"] = max(entry["max"], elapsed)
+
+
+def timed(func: F) -> F:
+    """Attributes wall-clock time spent in `func` to `timings`.
+
+    Coroutines are timed from first await to return, so overlapping calls
+    add up to more than the run itself; generators are timed per item."""
+    name = func.__name__
+
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                record_timing(name, time.perf_counter() - start)
+
+        return cast(F, async_wrapper)
+
+    if inspect.isasyncgenfunction(func):
+
+        @functools.wraps(func)
+        async def async_gen_wrapper(*args: Any, **kwargs: Any) -> Any:
+            gen = func(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                exhausted = False
+                try:
+                    item = await gen.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                    return
+                finally:
+                    # the step that ends the generator is timed but not an item
+                    elapsed = time.perf_counter() - start
+                    record_timing(name, elapsed, calls=0 if exhausted else 1)
+                yield item
+
+        return cast(F, async_gen_wrapper)
+
+    if inspect.isgeneratorfunction(func):
+
+        @functools.wraps(func)
+        def gen_wrapper(*args: Any, **kwargs: Any) -> Any:
+            gen = func(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                exhausted = False
+                try:
+                    item = next(gen)
+                except StopIteration:
+                    exhausted = True
+                    return
+                finally:
+                    # the step that ends the generator is timed but not an item
+                    elapsed = time.perf_counter() - start
+                    record_timing(name, elapsed, calls=0 if exhausted else 1)
+                yield item
+
+        return cast(F, gen_wrapper)
+
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record_timing(name, time.perf_counter() - start)
+
+    return cast(F, wrapper)
+
+
+@contextmanager
+def profiling(page_id: str, profile: bool, trace_memory: bool) -> Iterator[None]:
+    """Saves cProfile stats, top allocations and `timings` of the wrapped block
+    to cache/<page>/profile, named by start time so runs can be compared"""
+    if not profile and not trace_memory:
+        yield
+        return
+
+    out = pathlib.Path("cache", page_id, "profile")
+    out.mkdir(parents=True, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+
+    timings.clear()
+    profiler = cProfile.Profile() if profile else None
+    if trace_memory:
+        tracemalloc.start(25)
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(str(out / f"{stamp}.pstats"))
+            with open(out / f"{stamp}-profile.txt", "w") as f:
+                stats = pstats.Stats(profiler, stream=f)
+                stats.sort_stats("cumulative").print_stats(50)
+
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            snapshot.dump(str(out / f"{stamp}.tracemalloc"))
+            with open(out / f"{stamp}-memory.txt", "w") as f:
+                for stat in snapshot.statistics("traceback")[:25]:
+                    f.write(f"{stat}\n")
+                    f.writelines(f"    {line}\n" for line in stat.traceback.format())
+
+        with open(out / f"{stamp}-timings.json", "w") as f:
+            json.dump(timings, f, indent=2, sort_keys=True)
+
+        llog.info(f"Profile saved to {out} as {stamp}-*")
+
+
 def auth() -> Tuple[vk.vk_api.VkApi, vk.vk_api.VkApiMethod]:
     """Interactively authenticates user and returns api object"""
 
@@ -85,10 +254,310 @@ def auth() -> Tuple[vk.vk_api.VkApi, vk.vk_api.VkApiMethod]:
     return session, api
 
 
-def get_posts(
-    page_id: str, n_posts: int, api: vk.vk_api.VkApiMethod
-) -> Iterator[List[Dict[str, Any]]]:
-    total_posts = api.wall.get(domain=page_id, count=1, offset=0)["count"]
+API_URL = "https://api.vk.com/method/"
+API_REQUESTS_PER_SECOND = 3.0
+TOO_MANY_REQUESTS = 6
+TOO_MANY_REQUESTS_RETRIES = 10
+
+
+class AsyncApiError(Exception):
+    def __init__(self, method: str, error: Dict[str, Any]) -> None:
+        self.method = method
+        self.code: int = error.get("error_code", 0)
+        super().__init__(f"{method} failed: [{self.code}] {error.get('error_msg')}")
+
+
+SMALL_FILE_HINT = 512 << 10
+
+
+class ByteBudget:
+    """Counts bytes of transfers in flight against a shared limit.
+
+    Reservations are granted in arrival order, so a transfer that needs most
+    of the budget is not starved by a stream of small ones behind it."""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.used = 0
+        self._cond = asyncio.Condition()
+        self._waiters: Deque[object] = deque()
+
+    async def acquire(self, n: int, ceiling: int) -> int:
+        """Waits until `n` bytes fit under `ceiling`, returns the bytes reserved.
+
+        Transfers larger than the ceiling reserve all of it and run alone."""
+        n = min(n, ceiling)
+        ticket = object()
+        async with self._cond:
+            self._waiters.append(ticket)
+            try:
+                await self._cond.wait_for(
+                    lambda: self._waiters[0] is ticket and self.used + n <= ceiling
+                )
+            finally:
+                self._waiters.remove(ticket)
+                # the next waiter in line may fit as well
+                self._cond.notify_all()
+            self.used += n
+
+        return n
+
+    async def release(self, n: int) -> None:
+        async with self._cond:
+            self.used -= n
+            self._cond.notify_all()
+
+
+class HostBandwidth:
+    """Paces reads from one host to `rate` bytes per second"""
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self._next = 0.0
+
+    async def consume(self, n: int) -> None:
+        now = asyncio.get_running_loop().time()
+        self._next = max(now, self._next) + n / self.rate
+        delay = self._next - now - 1.0  # allow a second worth of burst
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class DownloadScheduler:
+    """Size-aware admission for media downloads.
+
+    Transfers go to the small or large lane by their Content-Length. Both
+    lanes share `max_connections` and an in-flight budget of `max_bytes`,
+    but large ones get at most `large_connections` sockets and three
+    quarters of the bytes, so photos keep flowing next to huge audio and
+    video files. `host_bandwidth` (bytes/s, 0 for unlimited) caps each host."""
+
+    def __init__(
+        self,
+        max_bytes: int = 256 << 20,
+        max_connections: int = 64,
+        large_connections: Optional[int] = None,
+        large_threshold: int = 4 << 20,
+        host_bandwidth: float = 0,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.max_connections = max_connections
+        self.large_connections = large_connections or max(1, max_connections // 4)
+        self.large_threshold = large_threshold
+        self.host_bandwidth = host_bandwidth
+        self._hosts: Dict[str, HostBandwidth] = {}
+
+    def start(self) -> None:
+        """Creates the primitives, must be called from the running loop"""
+        self.budget = ByteBudget(self.max_bytes)
+        self.connections = asyncio.Semaphore(self.max_connections)
+        self.large_lane = asyncio.Semaphore(self.large_connections)
+
+    @asynccontextmanager
+    async def slot(self, size: Optional[int]) -> AsyncIterator[None]:
+        size = SMALL_FILE_HINT if size is None else size
+        if size >= self.large_threshold:
+            async with self.large_lane:
+                async with self._admit(size, self.max_bytes * 3 // 4):
+                    yield
+        else:
+            async with self._admit(size, self.max_bytes):
+                yield
+
+    @asynccontextmanager
+    async def _admit(self, size: int, ceiling: int) -> AsyncIterator[None]:
+        reserved = await self.budget.acquire(size, ceiling)
+        try:
+            async with self.connections:
+                yield
+        finally:
+            await self.budget.release(reserved)
+
+    async def throttle(self, host: Optional[str], n: int) -> None:
+        if not self.host_bandwidth or host is None:
+            return
+
+        bucket = self._hosts.get(host)
+        if bucket is None:
+            bucket = self._hosts[host] = HostBandwidth(self.host_bandwidth)
+        await bucket.consume(n)
+
+
+class AsyncVkClient:
+    """Asyncio client for the API methods and downloads on the export hot path.
+
+    All requests share one aiohttp connection pool of `connections` sockets,
+    API calls are additionally throttled to `requests_per_second` and
+    downloads are admitted by `scheduler`."""
+
+    def __init__(
+        self,
+        token: str,
+        api_version: str,
+        connections: int = 100,
+        requests_per_second: float = API_REQUESTS_PER_SECOND,
+        scheduler: Optional[DownloadScheduler] = None,
+    ) -> None:
+        self.token = token
+        self.api_version = api_version
+        self.connections = connections
+        self.requests_per_second = requests_per_second
+        self.scheduler = scheduler or DownloadScheduler(max_connections=connections)
+        self._http: Optional[aiohttp.ClientSession] = None
+        self._next_call = 0.0
+
+    @classmethod
+    def from_session(cls, session: vk.VkApi, **kwargs: Any) -> "AsyncVkClient":
+        return cls(session.token["access_token"], session.api_version, **kwargs)
+
+    async def __aenter__(self) -> "AsyncVkClient":
+        # locks are created here so they bind to the running loop
+        self._rate_lock = asyncio.Lock()
+        self.scheduler.start()
+        self._http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connections),
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=60),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    @property
+    def http(self) -> aiohttp.ClientSession:
+        if self._http is None:
+            raise RuntimeError("AsyncVkClient is used outside of `async with`")
+
+        return self._http
+
+    async def _throttle(self) -> None:
+        loop = asyncio.get_running_loop()
+        async with self._rate_lock:
+            now = loop.time()
+            delay = self._next_call - now
+            self._next_call = max(now, self._next_call) + 1 / self.requests_per_second
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def call(self, method: str, **params: Any) -> Any:
+        data = {k: str(v) for k, v in params.items()}
+        data.update(access_token=self.token, v=self.api_version)
+
+        for _ in range(TOO_MANY_REQUESTS_RETRIES + 1):
+            await self._throttle()
+            async with self.http.post(API_URL + method, data=data) as resp:
+                resp.raise_for_status()
+                body = await resp.json()
+
+            if "error" not in body:
+                return body["response"]
+
+            error = AsyncApiError(method, body["error"])
+            if error.code != TOO_MANY_REQUESTS:
+                raise error
+
+            ic(error)
+
+        raise error
+
+    async def wall_get(self, **params: Any) -> Dict[str, Any]:
+        result: Dict[str, Any] = await self.call("wall.get", **params)
+        return result
+
+    async def execute(self, code: str) -> Any:
+        return await self.call("execute", code=code)
+
+    async def video_get(
+        self, videos: List[str], owner_id: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        params: Dict[str, Any] = {"videos": ",".join(videos), "count": len(videos)}
+        if owner_id is not None:
+            params["owner_id"] = owner_id
+        result = await self.call("video.get", **params)
+        items: List[Dict[str, Any]] = result["items"]
+        return items
+
+    async def pages_get(self, owner_id: int, page_id: str) -> str:
+        result = await self.call(
+            "pages.get", owner_id=owner_id, page_id=page_id, need_html=1
+        )
+        html: str = result["html"]
+        return html
+
+    async def resolve_screen_name(self, screen_name: str) -> int:
+        """Async counterpart of `domain_to_id`"""
+        data = await self.call("utils.resolveScreenName", screen_name=screen_name)
+        obj_id: int = data["object_id"]
+
+        return -obj_id if data["type"] == "group" else obj_id
+
+    async def photos_get_by_id(self, photos: List[str]) -> List[Dict[str, Any]]:
+        """`photos` are "<owner_id>_<photo_id>[_<access_key>]" triples"""
+        items: List[Dict[str, Any]] = await self.call(
+            "photos.getById", photos=",".join(photos)
+        )
+        return items
+
+    async def audio_get_by_id(self, audios: List[str]) -> List[Dict[str, Any]]:
+        """`audios` are "<owner_id>_<audio_id>" pairs"""
+        items: List[Dict[str, Any]] = await self.call(
+            "audio.getById", audios=",".join(audios)
+        )
+        return items
+
+    async def head(self, url: str) -> Mapping[str, str]:
+        async with self.http.head(url, allow_redirects=True) as resp:
+            resp.raise_for_status()
+            return resp.headers
+
+    async def content_length(self, url: str) -> Optional[int]:
+        try:
+            headers = await self.head(url)
+        except aiohttp.ClientError:
+            return None
+
+        length = headers.get("Content-Length")
+        return int(length) if length is not None else None
+
+    @asynccontextmanager
+    async def get(
+        self,
+        url: str,
+        size: Optional[int] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        """GET admitted by the scheduler, `size` is probed with HEAD if unknown"""
+        if size is None:
+            size = await self.content_length(url)
+
+        async with self.scheduler.slot(size):
+            async with self.http.get(url, headers=headers) as resp:
+                resp.raise_for_status()
+                yield resp
+
+    async def iter_body(self, resp: aiohttp.ClientResponse) -> AsyncIterator[bytes]:
+        async for chunk in resp.content.iter_chunked(1 << 16):
+            await self.scheduler.throttle(resp.url.host, len(chunk))
+            yield chunk
+
+    async def fetch(self, url: str, size: Optional[int] = None) -> bytes:
+        async with self.get(url, size) as resp:
+            return b"".join([chunk async for chunk in self.iter_body(resp)])
+
+    async def download(self, url: str, f: BinaryIO, size: Optional[int] = None) -> None:
+        async with self.get(url, size) as resp:
+            async for chunk in self.iter_body(resp):
+                f.write(chunk)
+
+
+@timed
+async def get_posts(
+    page_id: str, n_posts: int, client: AsyncVkClient
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    total_posts = (await client.wall_get(domain=page_id, count=1, offset=0))["count"]
 
     n_posts = min(n_posts, total_posts) if n_posts != -1 else total_posts
     ic(n_posts)
@@ -100,38 +569,152 @@ def get_posts(
         step_amount = min(step, n_posts)
         ic(step_amount)
 
-        yield api.wall.get(domain=page_id, count=step_amount, offset=offset * step)[
-            "items"
-        ]
+        resp = await client.wall_get(
+            domain=page_id, count=step_amount, offset=offset * step
+        )
+        yield resp["items"]
 
         n_posts -= step_amount
         offset += 1
 
 
-def process_post_json(post: Dict[str, Any], api) -> Dict[str, Any]:
-    def getter(*args: Hashable) -> Callable[[Mapping[Any, Any]], Any]:
-        """Helper to retrieve data from heavily nested JSONs"""
+def merge_shards(shards: Iterable[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Merges overlapping wall shards into one list ordered by id, newest first"""
+    posts: Dict[int, Dict[str, Any]] = {}
+    for shard in shards:
+        for post in shard:
+            posts.setdefault(post["id"], post)
+
+    return sorted(posts.values(), key=lambda post: post["id"], reverse=True)
+
+
+SHARD_OVERLAP = 10
 
-        def _getter(x: Mapping[Any, Any]) -> Any:
-            for k in args:
-                x = x[k]
 
-            return x
+@timed
+async def get_posts_sharded(
+    page_id: str, n_posts: int, client: AsyncVkClient, shards: int
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Fetches the wall as `shards` offset ranges concurrently.
 
-        return _getter
+    Shard boundaries are anchored by post id: once the first page of shard k
+    is read, shard k-1 keeps reading past its planned end until it reaches
+    the first post of shard k, so posts pushed across the boundary by
+    publications during the fetch are not lost. Shards start SHARD_OVERLAP
+    posts early, so the usual case needs no extra calls. Shards are yielded
+    in wall order as soon as each is fetched, with duplicates dropped."""
+    total_posts = (await client.wall_get(domain=page_id, count=1, offset=0))["count"]
 
-    def download_photo(photo: Dict[str, Any]) -> Dict[str, str]:
-        photos = photo["photo"]["sizes"]
-        best_pic = max(photos, key=getter("height"))
-        url: str = best_pic["url"]
-        return {"type": "photo", "url": url}
+    n_posts = min(n_posts, total_posts) if n_posts != -1 else total_posts
+    ic(n_posts)
+    if n_posts == 0:
+        return
+
+    step = 100
+    n_calls = -(-(n_posts + (shards - 1) * SHARD_OVERLAP) // step)
+    shard_size = -(-n_calls // shards) * step
+
+    ranges = [(0, min(shard_size, n_posts))]
+    while ranges[-1][1] < n_posts:
+        start = ranges[-1][1] - SHARD_OVERLAP
+        ranges.append((start, min(start + shard_size, n_posts)))
+
+    loop = asyncio.get_running_loop()
+    # id of the first post of each shard, None if the shard turned out empty
+    anchors: List["asyncio.Future[Optional[int]]"] = [
+        loop.create_future() for _ in ranges
+    ]
+
+    async def reached_next_shard(k: int, items: List[Dict[str, Any]]) -> bool:
+        if k + 1 == len(ranges):
+            return True
+
+        anchor = await anchors[k + 1]
+        ids = [post["id"] for post in items if not post.get("is_pinned")]
+        return anchor is not None and bool(ids) and min(ids) <= anchor
+
+    async def fetch_shard(k: int, start: int, end: int) -> List[Dict[str, Any]]:
+        items: List[Dict[str, Any]] = []
+        offset = start
+        try:
+            while offset < end or not await reached_next_shard(k, items):
+                step_amount = min(step, end - offset) if offset < end else step
+                ic(offset, step_amount)
+                resp = await client.wall_get(
+                    domain=page_id, count=step_amount, offset=offset
+                )
+                if not anchors[k].done():
+                    first = resp["items"][0]["id"] if resp["items"] else None
+                    anchors[k].set_result(first)
+                if not resp["items"]:
+                    break
+
+                items.extend(resp["items"])
+                offset += step_amount
+        except Exception as e:
+            # the previous shard waits on this anchor, fail it as well
+            if not anchors[k].done():
+                anchors[k].set_exception(e)
+            raise
+
+        return items
+
+    tasks = [
+        asyncio.ensure_future(fetch_shard(k, start, end))
+        for k, (start, end) in enumerate(ranges)
+    ]
+    seen: Set[int] = set()
+    try:
+        for task in tasks:
+            posts = [
+                post for post in merge_shards([await task]) if post["id"] not in seen
+            ]
+            seen.update(post["id"] for post in posts)
+            for i in range(0, len(posts), step):
+                yield posts[i : i + step]
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def getter(*args: Hashable) -> Callable[[Mapping[Any, Any]], Any]:
+    """Helper to retrieve data from heavily nested JSONs"""
+
+    def _getter(x: Mapping[Any, Any]) -> Any:
+        for k in args:
+            x = x[k]
+
+        return x
+
+    return _getter
+
+
+def best_photo_url(photo: Dict[str, Any]) -> str:
+    best_pic = max(photo["sizes"], key=getter("height"))
+    url: str = best_pic["url"]
+    return url
+
+
+@timed
+async def process_post_json(
+    post: Dict[str, Any], client: AsyncVkClient, video_quality: int = 720
+) -> Dict[str, Any]:
+    def download_photo(photo: Dict[str, Any]) -> Dict[str, Any]:
+        photo = photo["photo"]
+        return {
+            "type": "photo",
+            "url": best_photo_url(photo),
+            "id": photo["id"],
+            "owner_id": photo["owner_id"],
+            "access_key": photo.get("access_key", ""),
+        }
 
     def download_audio(audio: Dict[str, Any]) -> Dict[str, Any]:
         audio_id = audio["audio"]["id"]
         owner_id = audio["audio"]["owner_id"]
         return {"type": "audio", "id": audio_id, "owner_id": owner_id}
 
-    def download_video(video: Dict[str, Any]) -> Optional[Dict[str, str]]:
+    async def download_video(video: Dict[str, Any]) -> Dict[str, Any]:
         """Internal VK videos most likely wont be
         accessible if original page is not accessible"""
 
@@ -149,11 +732,19 @@ def process_post_json(post: Dict[str, Any], api) -> Dict[str, Any]:
             f"_{access_key}" if access_key != "" else ""
         )
         ic(f"{owner_id}_{video_id}")
-        real_video = api.video.get(videos=full_id, count=1, owner_id=owner_id)
+        real_video = await client.video_get([full_id], owner_id)
         ic(real_video)
-        url = real_video["items"][0]["player"]
-
-        return {"type": "video", "url": url}
+        url = real_video[0]["player"]
+        file_url = pick_video_file(real_video[0].get("files", {}), video_quality)
+
+        return {
+            "type": "video",
+            "url": url,
+            "file": file_url,
+            "id": video_id,
+            "owner_id": owner_id,
+            "access_key": access_key,
+        }
 
     text = post["text"]
     post_id = post["id"]
@@ -172,7 +763,7 @@ def process_post_json(post: Dict[str, Any], api) -> Dict[str, Any]:
             real_attachments.append(download_audio(attachment))
 
         if attachment["type"] == "video":
-            real_attachments.append(download_video(attachment))
+            real_attachments.append(await download_video(attachment))
 
     res: Dict[str, Any] = {
         "text": text,
@@ -208,8 +799,8 @@ def render_html(db: sqlite3.Connection) -> str:
     pass
 
 
-def initialize_table(page_id: str) -> sqlite3.Connection:
-    db = sqlite3.connect(f"cache/{page_id}/posts.db")
+def initialize_table(page_id: str, db_path: Optional[str] = None) -> sqlite3.Connection:
+    db = sqlite3.connect(db_path or f"cache/{page_id}/posts.db")
     sql_create_table = """CREATE TABLE IF NOT EXISTS posts (
             id INT NOT NULL PRIMARY KEY,
             text TEXT,
@@ -224,97 +815,883 @@ def initialize_table(page_id: str) -> sqlite3.Connection:
     return db
 
 
-def save_html(htmls: List[str], page_id: str, post_id: int):
-    wd = pathlib.PurePath("cache", page_id, "wikis", str(post_id))
-    try:
-        pathlib.Path(wd).mkdir(parents=True)
-    except FileExistsError:
-        if len(htmls) == list(os.listdir(pathlib.Path(wd))):
-            llog.info(f"Wiki from {post_id} are downloaded")
-            return
+MEDIA_TYPES = ["photos", "videos", "audios", "wikis"]
+MediaKey = Tuple[int, str, int]
 
-    for i, content in enumerate(htmls):
-        with open(pathlib.PurePath(wd, str(i)), "w") as f:
-            f.write(content)
 
+class FailureQueue:
+    """Media downloads that failed, kept in the page database until retried.
 
-def save_photos(photo_urls: List[str], page_id: str, post_id: int):
-    wd = pathlib.PurePath("cache", page_id, "photos", str(post_id))
-    try:
-        pathlib.Path(wd).mkdir(parents=True)
-    except FileExistsError:
-        if len(photo_urls) == list(os.listdir(pathlib.Path(wd))):
-            llog.info(f"Photos from {post_id} are downloaded")
+    Rows hold the attachment identity rather than its URL, as VK media URLs
+    expire; `retry` resolves fresh ones from it. Keys of queued rows are
+    kept in memory so successful downloads that were never queued cost
+    nothing, deletes are committed by `flush`."""
+
+    def __init__(self, db: sqlite3.Connection) -> None:
+        self.db = db
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS failures (
+            post_id INT NOT NULL,
+            type TEXT NOT NULL,
+            idx INT NOT NULL,
+            attachment TEXT NOT NULL,
+            error TEXT NOT NULL,
+            attempts INT NOT NULL,
+            last_attempt REAL NOT NULL,
+            PRIMARY KEY (post_id, type, idx));"""
+        )
+        self.db.commit()
+        self.known: Set[Tuple[int, str, int]] = set(
+            self.db.execute("SELECT post_id, type, idx FROM failures")
+        )
+
+    def record(
+        self,
+        post_id: int,
+        kind: str,
+        idx: int,
+        attachment: Dict[str, Any],
+        error: BaseException,
+        attempts: int,
+    ) -> None:
+        self.db.execute(
+            """INSERT INTO failures VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (post_id, type, idx) DO UPDATE SET
+            error = excluded.error,
+            attempts = attempts + excluded.attempts,
+            last_attempt = excluded.last_attempt""",
+            (
+                post_id,
+                kind,
+                idx,
+                json.dumps(attachment),
+                type(error).__name__,
+                attempts,
+                time.time(),
+            ),
+        )
+        self.db.commit()
+        self.known.add((post_id, kind, idx))
+
+    def resolve(self, post_id: int, kind: str, idx: int) -> None:
+        if (post_id, kind, idx) not in self.known:
             return
 
-    photos = []
-    for url in photo_urls:
-        req = requests.get(url)
+        self.known.discard((post_id, kind, idx))
+        self.db.execute(
+            "DELETE FROM failures WHERE post_id = ? AND type = ? AND idx = ?",
+            (post_id, kind, idx),
+        )
+
+    def flush(self) -> None:
+        self.db.commit()
+
+    def pending(self, max_attempts: int = -1) -> List[Tuple[int, str, int, Any]]:
+        rows = self.db.execute(
+            "SELECT post_id, type, idx, attachment FROM failures "
+            "WHERE ? = -1 OR attempts < ? ORDER BY post_id, type, idx",
+            (max_attempts, max_attempts),
+        ).fetchall()
+        return [
+            (post_id, kind, idx, json.loads(attachment))
+            for post_id, kind, idx, attachment in rows
+        ]
+
+
+class DirectoryStore:
+    """Media as one file per item: cache/<page>/<kind>/<post_id>/<index>"""
+
+    def __init__(self, page_id: str) -> None:
+        self.root = pathlib.Path("cache", page_id)
+
+    def path(self, post_id: int, kind: str, idx: int) -> pathlib.Path:
+        return self.root / kind / str(post_id) / str(idx)
+
+    def count(self, post_id: int, kind: str) -> int:
+        wd = self.root / kind / str(post_id)
+        if not wd.exists():
+            return 0
+
+        return sum(1 for name in os.listdir(wd) if name.isdigit())
+
+    def has(self, post_id: int, kind: str, idx: int) -> bool:
+        return self.path(post_id, kind, idx).exists()
+
+    def get(self, post_id: int, kind: str, idx: int) -> bytes:
+        return self.path(post_id, kind, idx).read_bytes()
+
+    def put(self, post_id: int, kind: str, idx: int, data: bytes) -> None:
+        with self.writer(post_id, kind, idx) as f:
+            f.write(data)
+
+    @contextmanager
+    def writer(
+        self, post_id: int, kind: str, idx: int, resume: bool = False
+    ) -> Iterator[BinaryIO]:
+        """File to stream an item into, published only if the block succeeds.
+
+        With `resume` a failed write keeps its partial file and the next
+        writer for the same item reopens it instead of starting empty."""
+        path = self.path(post_id, kind, idx)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        part = path.with_name(path.name + ".part")
+        try:
+            with open(part, "r+b" if resume and part.exists() else "w+b") as f:
+                yield f
+        except BaseException:
+            if not resume:
+                part.unlink(missing_ok=True)
+            raise
+
+        part.replace(path)
+
+    def keys(self) -> Iterator[MediaKey]:
+        for kind in MEDIA_TYPES:
+            kind_dir = self.root / kind
+            if not kind_dir.exists():
+                continue
+
+            for post_dir in sorted(kind_dir.iterdir(), key=lambda p: p.name):
+                if not post_dir.name.lstrip("-").isdigit():
+                    continue
+
+                for item in post_dir.iterdir():
+                    if item.name.isdigit():
+                        yield int(post_dir.name), kind, int(item.name)
+
+    def close(self) -> None:
+        pass
+
+
+class PackStore:
+    """Media appended to large segment files in cache/<page>/pack.
+
+    `index.db` maps (post_id, kind, index) to the segment, offset and length
+    of the item. Segments are append-only and read back through mmap; a key
+    written twice keeps its old bytes in the segment and the index points to
+    the newest copy."""
+
+    SEGMENT_SIZE = 1 << 30
+    COMMIT_EVERY = 256
+
+    def __init__(self, page_id: str) -> None:
+        self.root = pathlib.Path("cache", page_id, "pack")
+        self.root.mkdir(parents=True, exist_ok=True)
+        (self.root / "tmp").mkdir(exist_ok=True)
+
+        self.index = sqlite3.connect(str(self.root / "index.db"))
+        self.index.execute("PRAGMA journal_mode=WAL")
+        self.index.execute(
+            """CREATE TABLE IF NOT EXISTS pack_index (
+            post_id INT NOT NULL,
+            kind TEXT NOT NULL,
+            idx INT NOT NULL,
+            segment INT NOT NULL,
+            offset INT NOT NULL,
+            length INT NOT NULL,
+            PRIMARY KEY (post_id, kind, idx));"""
+        )
+        self.index.commit()
+
+        segments = sorted(self.root.glob("segment-*.pack"))
+        self._segment = int(segments[-1].stem.split("-")[1]) if segments else 0
+        self._out = open(self._segment_path(self._segment), "ab")
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._uncommitted = 0
+
+    @classmethod
+    def exists(cls, page_id: str) -> bool:
+        return pathlib.Path("cache", page_id, "pack", "index.db").exists()
+
+    def _segment_path(self, segment: int) -> pathlib.Path:
+        return self.root / f"segment-{segment:05}.pack"
+
+    def _lookup(self, post_id: int, kind: str, idx: int) -> Tuple[int, int, int]:
+        row = self.index.execute(
+            "SELECT segment, offset, length FROM pack_index "
+            "WHERE post_id = ? AND kind = ? AND idx = ?",
+            (post_id, kind, idx),
+        ).fetchone()
+        if row is None:
+            raise KeyError((post_id, kind, idx))
+
+        segment, offset, length = row
+        return int(segment), int(offset), int(length)
+
+    def count(self, post_id: int, kind: str) -> int:
+        row = self.index.execute(
+            "SELECT COUNT(*) FROM pack_index WHERE post_id = ? AND kind = ?",
+            (post_id, kind),
+        ).fetchone()
+        return int(row[0])
+
+    def has(self, post_id: int, kind: str, idx: int) -> bool:
         try:
-            req.raise_for_status()
-        except requests.exceptions.HTTPError:
-            llog.err("Failed fetching an image, URL is logged in err.log")
-            with open("err.log", "a") as f:
-                f.write(url + "\n")
+            self._lookup(post_id, kind, idx)
+        except KeyError:
+            return False
+
+        return True
+
+    def view(self, post_id: int, kind: str, idx: int) -> memoryview:
+        """Zero-copy view of an item, valid until the store is closed.
+
+        A segment still referenced by a view when the store closes stays
+        mapped until the last view is released."""
+        segment, offset, length = self._lookup(post_id, kind, idx)
+        if length == 0:
+            return memoryview(b"")
+        if segment == self._segment:
+            self._out.flush()
+
+        mm = self._maps.get(segment)
+        if mm is None or len(mm) < offset + length:
+            with open(self._segment_path(segment), "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = mm
+
+        return memoryview(mm)[offset : offset + length]
+
+    def get(self, post_id: int, kind: str, idx: int) -> bytes:
+        return bytes(self.view(post_id, kind, idx))
+
+    def _append(self, key: MediaKey, src: BinaryIO) -> None:
+        if self._out.tell() >= self.SEGMENT_SIZE:
+            self._out.close()
+            self._segment += 1
+            self._out = open(self._segment_path(self._segment), "ab")
+
+        offset = self._out.tell()
+        shutil.copyfileobj(src, self._out)
+        length = self._out.tell() - offset
+
+        self.index.execute(
+            "INSERT OR REPLACE INTO pack_index VALUES (?, ?, ?, ?, ?, ?)",
+            (*key, self._segment, offset, length),
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= self.COMMIT_EVERY:
+            self.flush()
+
+    def put(self, post_id: int, kind: str, idx: int, data: bytes) -> None:
+        self._append((post_id, kind, idx), io.BytesIO(data))
+
+    def put_file(self, post_id: int, kind: str, idx: int, path: pathlib.Path) -> None:
+        with open(path, "rb") as f:
+            self._append((post_id, kind, idx), f)
+
+    @contextmanager
+    def writer(
+        self, post_id: int, kind: str, idx: int, resume: bool = False
+    ) -> Iterator[BinaryIO]:
+        """Streams into a scratch file that is appended to the pack on success,
+        `resume` works as in `DirectoryStore.writer`"""
+        part = self.root / "tmp" / f"{post_id}-{kind}-{idx}.part"
+        try:
+            with open(part, "r+b" if resume and part.exists() else "w+b") as f:
+                yield f
+                f.seek(0)
+                self._append((post_id, kind, idx), f)
+        except BaseException:
+            if not resume:
+                part.unlink(missing_ok=True)
+            raise
+
+        part.unlink()
+
+    def keys(self) -> Iterator[MediaKey]:
+        rows = self.index.execute(
+            "SELECT post_id, kind, idx FROM pack_index ORDER BY post_id, kind, idx"
+        )
+        for post_id, kind, idx in rows.fetchall():
+            yield post_id, kind, idx
+
+    def flush(self) -> None:
+        self._out.flush()
+        self.index.commit()
+        self._uncommitted = 0
+
+    def close(self) -> None:
+        try:
+            self.flush()
+            self._out.close()
+            for mm in self._maps.values():
+                try:
+                    mm.close()
+                except BufferError:
+                    # exported views keep the mapping alive, it is unmapped
+                    # once they are garbage collected
+                    pass
+            self._maps.clear()
+        finally:
+            self.index.close()
+
+
+MediaStore = Union[DirectoryStore, PackStore]
+
+
+def open_store(page_id: str, storage: Optional[str] = None) -> MediaStore:
+    """Opens the media store of a page, detecting the layout when `storage` is None"""
+    if storage is None:
+        storage = "pack" if PackStore.exists(page_id) else "dir"
+
+    if storage == "pack":
+        return PackStore(page_id)
+    if storage == "dir":
+        return DirectoryStore(page_id)
+
+    raise ValueError(f'Unknown storage "{storage}", expected "dir" or "pack"')
+
+
+@timed
+def save_html(htmls: List[str], store: MediaStore, post_id: int):
+    if htmls and store.count(post_id, "wikis") == len(htmls):
+        llog.info(f"Wiki from {post_id} are downloaded")
+        return
+
+    for i, content in enumerate(htmls):
+        store.put(post_id, "wikis", i, content.encode())
+
+
+HLS_WINDOW = 8
+HLS_ATTRIBUTE_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+MAX_VARIANT_HOPS = 4
+
+
+class BrokenMedia(Exception):
+    """The server returned media that can't be decoded, retrying won't help"""
+
+
+class HlsSegment(NamedTuple):
+    url: str
+    key_url: Optional[str]
+    iv: bytes
+
+
+class HlsPlaylist(NamedTuple):
+    segments: List[HlsSegment]
+    variants: List[Tuple[int, str]]
+
+
+def parse_m3u8(text: str, base_url: str) -> HlsPlaylist:
+    """Parses a media playlist into segments or a master one into variants"""
+    segments: List[HlsSegment] = []
+    variants: List[Tuple[int, str]] = []
+    sequence = 0
+    key_url: Optional[str] = None
+    key_iv: Optional[bytes] = None
+    bandwidth: Optional[int] = None
+
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith("#"):
+            tag, _, value = line.partition(":")
+            attrs = {k: v.strip('"') for k, v in HLS_ATTRIBUTE_RE.findall(value)}
+            try:
+                if tag == "#EXT-X-MEDIA-SEQUENCE":
+                    sequence = int(value)
+                elif tag == "#EXT-X-KEY":
+                    if attrs.get("METHOD") == "AES-128":
+                        key_url = urljoin(base_url, attrs["URI"])
+                        iv = attrs.get("IV")
+                        key_iv = bytes.fromhex(iv[2:]) if iv else None
+                    else:
+                        key_url, key_iv = None, None
+                elif tag == "#EXT-X-STREAM-INF":
+                    bandwidth = int(attrs.get("BANDWIDTH", 0))
+            except (KeyError, ValueError) as e:
+                raise BrokenMedia(f"Malformed {tag} in {base_url}") from e
+            continue
+
+        url = urljoin(base_url, line)
+        if bandwidth is not None:
+            variants.append((bandwidth, url))
+            bandwidth = None
         else:
-            photos.append(req.content)
+            iv = key_iv or (sequence + len(segments)).to_bytes(16, "big")
+            segments.append(HlsSegment(url, key_url, iv))
 
-    for i, content in enumerate(photos):
-        with open(pathlib.PurePath(wd, str(i)), "wb") as f:  # type: ignore
-            f.write(content)
+    return HlsPlaylist(segments, variants)
 
 
-def save_audios(audio_objs: List[Dict[str, str]], page_id: str, post_id: int, session):
-    wd = pathlib.PurePath("cache", page_id, "audios", str(post_id))
-    audio_api = vk_audio_api.VkAudio(session)
+def is_playlist(url: str, content_type: str) -> bool:
+    return urlsplit(url).path.endswith(".m3u8") or "mpegurl" in content_type.lower()
+
+
+def decrypt_segment(data: bytes, key: bytes, iv: bytes) -> bytes:
+    try:
+        decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+        unpadder = padding.PKCS7(128).unpadder()
+        plain = decryptor.update(data) + decryptor.finalize()
+        return unpadder.update(plain) + unpadder.finalize()
+    except ValueError as e:
+        raise BrokenMedia("Segment does not decrypt with its key") from e
+
+
+async def download_hls(
+    client: AsyncVkClient, playlist: HlsPlaylist, f: BinaryIO
+) -> None:
+    """Fetches segments HLS_WINDOW at a time and writes them to `f` in order"""
+    keys = {
+        key_url: await client.fetch(key_url, SMALL_FILE_HINT)
+        for key_url in {segment.key_url for segment in playlist.segments}
+        if key_url is not None
+    }
+
+    async def fetch_segment(segment: HlsSegment) -> bytes:
+        data = await client.fetch(segment.url, SMALL_FILE_HINT)
+        if segment.key_url is None:
+            return data
+
+        return decrypt_segment(data, keys[segment.key_url], segment.iv)
+
+    pending: Deque["asyncio.Task[bytes]"] = deque()
     try:
-        pathlib.Path(wd).mkdir(parents=True)
-    except FileExistsError:
-        if len(audio_objs) == list(os.listdir(pathlib.Path(wd))):
-            llog.info(f"Audios from {post_id} are downloaded")
+        for segment in playlist.segments:
+            pending.append(asyncio.ensure_future(fetch_segment(segment)))
+            if len(pending) >= HLS_WINDOW:
+                f.write(await pending.popleft())
+
+        while pending:
+            f.write(await pending.popleft())
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def download_audio(client: AsyncVkClient, url: str, f: BinaryIO) -> None:
+    """Saves an audio to `f`, joining the segments if `url` is an HLS playlist"""
+    async with client.get(url) as resp:
+        if not is_playlist(str(resp.url), resp.content_type):
+            async for chunk in client.iter_body(resp):
+                f.write(chunk)
             return
 
-    audios = []
-    for audio_obj in audio_objs:
-        content = audio_api.get_audio_by_id(audio_obj["owner_id"], audio_obj["id"])
-        audios.append(content)
+        playlist = parse_m3u8(await resp.text(), str(resp.url))
+
+    for _ in range(MAX_VARIANT_HOPS):
+        if playlist.segments or not playlist.variants:
+            break
+        _, variant_url = max(playlist.variants)
+        async with client.get(variant_url, SMALL_FILE_HINT) as resp:
+            playlist = parse_m3u8(await resp.text(), str(resp.url))
+
+    if not playlist.segments:
+        raise BrokenMedia(f"No segments reachable from {url}")
+
+    await download_hls(client, playlist, f)
+
+
+VIDEO_CONNECTIONS = 4
+RANGE_CHUNK_SIZE = 8 << 20
+
+
+class IncompleteDownload(aiohttp.ClientPayloadError):
+    pass
+
+
+class RangesIgnored(Exception):
+    """The server advertised Accept-Ranges but answered a Range request in full"""
 
-    audio_files = []
-    for data in audios:
-        url = data["url"]
-        req = requests.get(url)
+
+def pick_video_file(files: Dict[str, str], max_quality: int) -> Optional[str]:
+    """Best mp4 variant of `video.get` files not above `max_quality` lines"""
+    variants = []
+    for name, url in files.items():
+        quality = name[len("mp4_") :]
+        if name.startswith("mp4_") and quality.isdigit():
+            variants.append((int(quality), url))
+
+    fitting = [variant for variant in variants if variant[0] <= max_quality]
+    if fitting:
+        return max(fitting)[1]
+
+    return min(variants)[1] if variants else None
+
+
+async def download_ranged(
+    client: AsyncVkClient,
+    url: str,
+    f: BinaryIO,
+    connections: int = VIDEO_CONNECTIONS,
+    chunk_size: int = RANGE_CHUNK_SIZE,
+) -> None:
+    """Downloads `url` over several Range requests into a preallocated `f`.
+
+    Finished chunks are listed in a `<file>.ranges` sidecar, so a download
+    interrupted with the partial file kept resumes from the missing chunks."""
+    headers = await client.head(url)
+    length = headers.get("Content-Length")
+    size = int(length) if length is not None else None
+    ranged = headers.get("Accept-Ranges") == "bytes"
+
+    ranges_path = pathlib.Path(f.name + ".ranges")
+
+    async def download_whole() -> None:
+        f.seek(0)
+        f.truncate()
+        await client.download(url, f, size)
+
+    if size is None or not ranged or size <= chunk_size:
+        ranges_path.unlink(missing_ok=True)
+        await download_whole()
+        return
+
+    n_chunks = -(-size // chunk_size)
+    header = f"{size} {chunk_size}"
+    done: Set[int] = set()
+    if ranges_path.exists() and os.fstat(f.fileno()).st_size == size:
+        # the last line may be torn if the process died while writing it
+        first, *lines = ranges_path.read_text().split("\n")[:-1]
+        if first == header:
+            done = {int(n) for n in lines if n.isdigit() and int(n) < n_chunks}
+    if not done:
+        ranges_path.write_text(f"{header}\n")
+        f.truncate(size)
+
+    semaphore = asyncio.Semaphore(connections)
+    received: Dict[int, int] = {}
+
+    def chunk_range(n: int) -> Tuple[int, int]:
+        start = n * chunk_size
+        return start, min(start + chunk_size, size) - 1
+
+    async def fetch_chunk(n: int, ranges: TextIO) -> None:
+        start, end = chunk_range(n)
+        async with semaphore:
+            headers = {"Range": f"bytes={start}-{end}"}
+            async with client.get(url, end - start + 1, headers) as resp:
+                if resp.status != 206:
+                    raise RangesIgnored()
+
+                pos = start
+                async for data in client.iter_body(resp):
+                    if pos + len(data) > end + 1:
+                        raise IncompleteDownload(f"chunk {n} overruns its range")
+                    f.seek(pos)
+                    f.write(data)
+                    pos += len(data)
+
+        if pos != end + 1:
+            raise IncompleteDownload(f"chunk {n} is {pos - start} bytes short")
+        received[n] = pos - start
+        f.flush()
+        ranges.write(f"{n}\n")
+        ranges.flush()
+
+    with open(ranges_path, "a") as ranges:
+        tasks = [
+            asyncio.ensure_future(fetch_chunk(n, ranges))
+            for n in range(n_chunks)
+            if n not in done
+        ]
         try:
-            req.raise_for_status()
-        except requests.exceptions.HTTPError:
-            llog.err("Failed fetching an audio, URL is logged in err.log")
-            with open("err.log", "a") as f:
-                f.write(url + "\n")
-        else:
-            audio_files.append(req.content)
+            await asyncio.gather(*tasks)
+        except RangesIgnored:
+            ranged = False
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    if not ranged:
+        ranges_path.unlink()
+        await download_whole()
+        return
+
+    resumed = sum(end - start + 1 for start, end in map(chunk_range, done))
+    if done | received.keys() != set(range(n_chunks)) or (
+        resumed + sum(received.values()) != size
+    ):
+        raise IncompleteDownload(f"chunks do not add up to {size} bytes")
+
+    ranges_path.unlink()
+
+
+class DownloadError(Exception):
+    def __init__(self, cause: BaseException, attempts: int) -> None:
+        self.cause = cause
+        self.attempts = attempts
+        super().__init__(f"{type(cause).__name__} after {attempts} attempts")
+
 
-    for i, content in enumerate(audio_files):
-        with open(pathlib.PurePath(wd, str(i)), "wb") as f:  # type: ignore
-            f.write(content)
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
 
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
 
-def extract_wiki(text: str, numeric_page_id: int, api) -> List[str]:
+
+async def with_retries(
+    download: Callable[[], Awaitable[T]], attempts: int = 4, base_delay: float = 1.0
+) -> T:
+    """Runs `download`, retrying transient errors with exponential backoff"""
+    for attempt in range(1, attempts + 1):
+        try:
+            return await download()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == attempts or not is_retryable(e):
+                raise DownloadError(e, attempt) from e
+
+            delay = base_delay * 2 ** (attempt - 1)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+
+    raise AssertionError("unreachable")
+
+
+async def resolve_photo_urls(
+    photo_objs: List[Dict[str, Any]], client: AsyncVkClient
+) -> Dict[Tuple[int, int], str]:
+    """Fresh URLs of photos by (owner_id, id)"""
+    ids = [
+        f"{photo['owner_id']}_{photo['id']}"
+        + (f"_{photo['access_key']}" if photo.get("access_key") else "")
+        for photo in photo_objs
+    ]
+    urls = {}
+    for i in range(0, len(ids), 100):
+        for photo in await client.photos_get_by_id(ids[i : i + 100]):
+            urls[photo["owner_id"], photo["id"]] = best_photo_url(photo)
+
+    return urls
+
+
+async def resolve_video_urls(
+    video_objs: List[Dict[str, Any]], client: AsyncVkClient, video_quality: int
+) -> Dict[Tuple[int, int], str]:
+    """Fresh file URLs of videos by (owner_id, id), external videos are left out"""
+    ids = [
+        f"{video['owner_id']}_{video['id']}"
+        + (f"_{video['access_key']}" if video.get("access_key") else "")
+        for video in video_objs
+    ]
+    urls = {}
+    for i in range(0, len(ids), 200):
+        for video in await client.video_get(ids[i : i + 200]):
+            url = pick_video_file(video.get("files", {}), video_quality)
+            if url is not None:
+                urls[video["owner_id"], video["id"]] = url
+
+    return urls
+
+
+class AudioScraper:
+    """Fallback for tokens that can't call audio.getById.
+
+    Scrapes the mobile site through vk_api, whose `requests` session is not
+    thread-safe, so all scraping runs on one worker thread and VkAudio (which
+    makes blocking requests when created) is built there on first use."""
+
+    def __init__(self, session: vk.VkApi) -> None:
+        self.session = session
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self._audio_api: Optional[vk_audio_api.VkAudio] = None
+
+    def _post_audio(self, owner_id: int, post_id: int) -> List[Dict[str, Any]]:
+        if self._audio_api is None:
+            self._audio_api = vk_audio_api.VkAudio(self.session)
+
+        return list(self._audio_api.get_post_audio(owner_id, post_id))
+
+    async def post_audio(self, owner_id: int, post_id: int) -> List[Dict[str, Any]]:
+        """Audios attached to post `post_id` of wall `owner_id`"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.pool, self._post_audio, owner_id, post_id
+        )
+
+    def close(self) -> None:
+        self.pool.shutdown()
+
+
+async def resolve_audio_urls(
+    audio_objs: List[Tuple[int, Dict[str, Any]]],
+    owner_id: int,
+    scraper: AudioScraper,
+    client: AsyncVkClient,
+) -> Dict[Tuple[int, int], str]:
+    """URLs of audios by (owner_id, id), unavailable audios are left out.
+
+    `audio_objs` are (post_id, audio) pairs of posts on the wall of `owner_id`"""
+    if not audio_objs:
+        return {}
+
+    ids = [f"{audio['owner_id']}_{audio['id']}" for _, audio in audio_objs]
+    try:
+        audios = []
+        for i in range(0, len(ids), 100):
+            audios.extend(await client.audio_get_by_id(ids[i : i + 100]))
+    except AsyncApiError:
+        # audio.getById is only open to some app ids, scrape each post instead
+        post_ids = sorted({post_id for post_id, _ in audio_objs})
+        audios = [
+            audio
+            for post_audios in await asyncio.gather(
+                *(scraper.post_audio(owner_id, post_id) for post_id in post_ids)
+            )
+            for audio in post_audios
+        ]
+
+    return {
+        (audio["owner_id"], audio["id"]): audio["url"]
+        for audio in audios
+        if audio and audio.get("url")
+    }
+
+
+async def save_media(
+    kind: str,
+    idx: int,
+    attachment: Dict[str, Any],
+    url: Optional[str],
+    store: MediaStore,
+    post_id: int,
+    client: AsyncVkClient,
+    failures: FailureQueue,
+) -> bool:
+    """Downloads one item into the store, queueing it in `failures` on error"""
+
+    if url is None:
+        llog.err(f"Failed resolving {kind} {post_id}/{idx}, queued for retry")
+        failures.record(post_id, kind, idx, attachment, LookupError(), 1)
+        return False
+
+    async def download() -> None:
+        assert url is not None
+        with store.writer(post_id, kind, idx, resume=kind == "videos") as f:
+            if kind == "audios":
+                await download_audio(client, url, f)
+            elif kind == "videos":
+                await download_ranged(client, url, f)
+            else:
+                await client.download(url, f, SMALL_FILE_HINT)
+
+    try:
+        await with_retries(download)
+    except DownloadError as e:
+        llog.err(f"Failed fetching {kind} {post_id}/{idx}, queued for retry")
+        failures.record(post_id, kind, idx, attachment, e.cause, e.attempts)
+        return False
+    except BrokenMedia as e:
+        llog.err(f"Failed decoding {kind} {post_id}/{idx}, queued for retry")
+        failures.record(post_id, kind, idx, attachment, e, 1)
+        return False
+
+    failures.resolve(post_id, kind, idx)
+    return True
+
+
+@timed
+async def save_photos(
+    photo_objs: List[Dict[str, Any]],
+    store: MediaStore,
+    post_id: int,
+    client: AsyncVkClient,
+    failures: FailureQueue,
+):
+    if photo_objs and store.count(post_id, "photos") == len(photo_objs):
+        llog.info(f"Photos from {post_id} are downloaded")
+        return
+
+    await asyncio.gather(
+        *(
+            save_media(
+                "photos", i, photo, photo["url"], store, post_id, client, failures
+            )
+            for i, photo in enumerate(photo_objs)
+            if not store.has(post_id, "photos", i)
+        )
+    )
+
+
+@timed
+async def save_audios(
+    audio_objs: List[Dict[str, Any]],
+    audio_urls: Dict[Tuple[int, int], str],
+    store: MediaStore,
+    post_id: int,
+    client: AsyncVkClient,
+    failures: FailureQueue,
+):
+    """`audio_urls` are looked up by `resolve_audio_urls` for the whole batch"""
+    if not audio_objs:
+        return
+
+    if store.count(post_id, "audios") == len(audio_objs):
+        llog.info(f"Audios from {post_id} are downloaded")
+        return
+
+    await asyncio.gather(
+        *(
+            save_media(
+                "audios",
+                i,
+                audio,
+                audio_urls.get((audio["owner_id"], audio["id"])),
+                store,
+                post_id,
+                client,
+                failures,
+            )
+            for i, audio in enumerate(audio_objs)
+            if not store.has(post_id, "audios", i)
+        )
+    )
+
+
+@timed
+async def save_videos(
+    video_objs: List[Dict[str, Any]],
+    store: MediaStore,
+    post_id: int,
+    client: AsyncVkClient,
+    failures: FailureQueue,
+):
+    """Saves the files of VK-hosted videos, external ones only have a player"""
+    if video_objs and store.count(post_id, "videos") == len(video_objs):
+        llog.info(f"Videos from {post_id} are downloaded")
+        return
+
+    await asyncio.gather(
+        *(
+            save_media(
+                "videos", i, video, video["file"], store, post_id, client, failures
+            )
+            for i, video in enumerate(video_objs)
+            if video.get("file") and not store.has(post_id, "videos", i)
+        )
+    )
+
+
+@timed
+async def extract_wiki(
+    text: str, numeric_page_id: int, client: AsyncVkClient
+) -> List[str]:
     wiki_re = re.compile(f"https:\/\/vk\.com\/topic{numeric_page_id}_[\d]{{1,20}}")
     urls = wiki_re.findall(text)
-    page_ids = [urls.split("_")[-1] for url in urls]
-    resps = [
-        api.pages.get(owner_id=numeric_page_id, page_id=page_id, need_html=1)
-        for page_id in page_ids
-    ]
-    htmls = []
-    for resp in resps:
-        htmls.append(resp["html"])
+    page_ids = [url.split("_")[-1] for url in urls]
+    htmls: List[str] = await asyncio.gather(
+        *(client.pages_get(numeric_page_id, page_id) for page_id in page_ids)
+    )
 
     return htmls
 
 
-def save_data(
-    post: Dict[Any, Any], db: sqlite3.Connection, page_id: str, session
+@timed
+async def save_data(
+    post: Dict[Any, Any],
+    db: sqlite3.Connection,
+    store: Optional[MediaStore],
+    numeric_page_id: int,
+    audio_urls: Dict[Tuple[int, int], str],
+    client: AsyncVkClient,
+    failures: FailureQueue,
 ) -> None:
+    """Stores the post and downloads its media into `store`, if one is given"""
     post = defaultdict(str, post)
     c = db.cursor()
     sql_insert_post = """INSERT INTO posts (id, text, photos, audios, videos) VALUES (?, ?, ?, ?, ?)"""
@@ -351,44 +1728,672 @@ def save_data(
     else:
         db.commit()
 
-    save_photos([photo["url"] for photo in photos], page_id, post_id)
-    save_audios(audios, page_id, post_id, session)
+    if store is None:
+        return
 
-    api = session.get_api()
-    htmls = extract_wiki(text, domain_to_id(page_id, api), api)
-    save_html(htmls, page_id, post_id)
+    await asyncio.gather(
+        save_photos(photos, store, post_id, client, failures),
+        save_audios(audios, audio_urls, store, post_id, client, failures),
+        save_videos(videos, store, post_id, client, failures),
+    )
+
+    htmls = await extract_wiki(text, numeric_page_id, client)
+    save_html(htmls, store, post_id)
+
+
+ARCHIVE_MAGIC = b"VKEXARC1"
+ARCHIVE_FOOTER = struct.Struct("<QQ8s")
+
+
+class ArchiveWriter:
+    """Single-file seekable archive of a page cache.
+
+    Members are split into blocks that are zlib-compressed independently on
+    a thread pool and written in order right after the magic; a compressed
+    JSON index of member -> [(offset, compressed, size), ...] and a fixed
+    footer pointing at it follow. Any byte range of a member can be read back
+    by decompressing only the blocks that cover it."""
+
+    BLOCK_SIZE = 1 << 22
+
+    def __init__(self, path: str, page_id: str, workers: int, level: int = 6) -> None:
+        self.path = path
+        self.out = open(path, "wb")
+        self.out.write(ARCHIVE_MAGIC)
+        self.page_id = page_id
+        self.level = level
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.members: Dict[str, Dict[str, Any]] = {}
+
+    def _chunks(
+        self, files: Iterable[Tuple[str, pathlib.Path]]
+    ) -> Iterator[Tuple[str, bytes]]:
+        for name, path in files:
+            self.members[name] = {"size": 0, "blocks": []}
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(self.BLOCK_SIZE), b""):
+                    yield name, chunk
+
+    def add_files(self, files: Iterable[Tuple[str, pathlib.Path]]) -> None:
+        # bounded window of in-flight blocks keeps memory at O(workers)
+        pending: Deque[Tuple[str, int, "Future[bytes]"]] = deque()
+        try:
+            for name, chunk in self._chunks(files):
+                compressed = self.pool.submit(zlib.compress, chunk, self.level)
+                pending.append((name, len(chunk), compressed))
+                if len(pending) >= self.workers * 2:
+                    self._write_block(*pending.popleft())
+
+            while pending:
+                self._write_block(*pending.popleft())
+        finally:
+            for _, _, compressed in pending:
+                compressed.cancel()
+
+    def _write_block(self, name: str, size: int, compressed: "Future[bytes]") -> None:
+        data = compressed.result()
+        member = self.members[name]
+        member["blocks"].append((self.out.tell(), len(data), size))
+        member["size"] += size
+        self.out.write(data)
+
+    def abort(self) -> None:
+        """Discards a partly written archive, e.g. after `add_files` failed"""
+        self.pool.shutdown()
+        self.out.close()
+        os.unlink(self.path)
+
+    def close(self) -> None:
+        self.pool.shutdown()
+        index = zlib.compress(
+            json.dumps({"page_id": self.page_id, "members": self.members}).encode()
+        )
+        index_offset = self.out.tell()
+        self.out.write(index)
+        self.out.write(ARCHIVE_FOOTER.pack(index_offset, len(index), ARCHIVE_MAGIC))
+        self.out.close()
+
+
+def is_relative_name(name: str) -> bool:
+    """Whether `name` stays inside the directory it is joined to"""
+    path = pathlib.PurePosixPath(name)
+    return (
+        bool(name)
+        and "\\" not in name
+        and not path.is_absolute()
+        and not pathlib.PureWindowsPath(name).drive
+        and ".." not in path.parts
+    )
+
+
+class ArchiveReader:
+    def __init__(self, path: str) -> None:
+        self.f = open(path, "rb")
+        if self.f.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            raise ValueError(f"{path} is not a page archive")
+
+        self.f.seek(-ARCHIVE_FOOTER.size, os.SEEK_END)
+        index_offset, index_length, magic = ARCHIVE_FOOTER.unpack(
+            self.f.read(ARCHIVE_FOOTER.size)
+        )
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError(f"{path} is truncated")
+
+        self.f.seek(index_offset)
+        index = json.loads(zlib.decompress(self.f.read(index_length)))
+        self.page_id: str = index["page_id"]
+        self.members: Dict[str, Dict[str, Any]] = index["members"]
+
+        # names become paths under cache/<page> on import
+        if pathlib.PurePosixPath(self.page_id).parts != (self.page_id,) or (
+            not is_relative_name(self.page_id)
+        ):
+            raise ValueError(f"{path} has an unsafe page id {self.page_id!r}")
+        for name in self.members:
+            if not is_relative_name(name):
+                raise ValueError(f"{path} has an unsafe member {name!r}")
+
+    def _blocks(self, name: str, offset: int, length: int) -> Iterator[bytes]:
+        """Yields the pieces of member `name` covering [offset, offset + length)"""
+        end = offset + length
+        block_start = 0
+        for block_offset, compressed, size in self.members[name]["blocks"]:
+            block_end = block_start + size
+            if block_end > offset and block_start < end:
+                self.f.seek(block_offset)
+                data = zlib.decompress(self.f.read(compressed))
+                yield data[max(offset - block_start, 0) : end - block_start]
+            if block_end >= end:
+                break
+            block_start = block_end
+
+    def read(self, name: str, offset: int = 0, length: Optional[int] = None) -> bytes:
+        if length is None:
+            length = self.members[name]["size"] - offset
+
+        return b"".join(self._blocks(name, offset, length))
+
+    def copy(
+        self, name: str, out: BinaryIO, offset: int = 0, length: Optional[int] = None
+    ) -> None:
+        if length is None:
+            length = self.members[name]["size"] - offset
+
+        for piece in self._blocks(name, offset, length):
+            out.write(piece)
+
+    def extract(self, name: str, path: pathlib.Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as out:
+            self.copy(name, out)
+
+    def close(self) -> None:
+        self.f.close()
+
+
+def cache_files(page_id: str) -> Iterator[Tuple[str, pathlib.Path]]:
+    """Files of a page cache as (archive member name, path), scratch files excluded"""
+    root = pathlib.Path("cache", page_id)
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d != "tmp")
+        for filename in sorted(filenames):
+            if filename.endswith((".part", ".ranges")):
+                continue
+
+            path = pathlib.Path(dirpath, filename)
+            yield path.relative_to(root).as_posix(), path
 
 
 def init_working_directory(page_id: str):
     pathlib.Path(f"cache/{page_id}").mkdir(parents=True, exist_ok=True)
 
-    for t in ["photos", "videos", "audios", "wikis"]:
+    for t in MEDIA_TYPES:
         pathlib.Path(f"cache/{page_id}/{t}").mkdir(parents=True, exist_ok=True)
 
 
+async def export_posts(
+    db: sqlite3.Connection,
+    page_id: str,
+    n_posts: int,
+    shards: int,
+    store: Optional[MediaStore],
+    session: vk.VkApi,
+    connections: int,
+    video_quality: int = 720,
+    scheduler: Optional[DownloadScheduler] = None,
+    requests_per_second: float = API_REQUESTS_PER_SECOND,
+) -> None:
+    async with AsyncVkClient.from_session(
+        session,
+        connections=connections,
+        requests_per_second=requests_per_second,
+        scheduler=scheduler,
+    ) as client:
+        numeric_page_id = await client.resolve_screen_name(page_id)
+        failures = FailureQueue(db)
+        scraper = AudioScraper(session)
+        try:
+            if shards > 1:
+                batches = get_posts_sharded(page_id, n_posts, client, shards)
+            else:
+                batches = get_posts(page_id, n_posts, client)
+
+            async for batch in batches:
+                posts = await asyncio.gather(
+                    *(process_post_json(post, client, video_quality) for post in batch)
+                )
+
+                audio_urls = {}
+                if store is not None:
+                    missing: List[Tuple[int, Dict[str, Any]]] = []
+                    for post in posts:
+                        audios = [
+                            a for a in post["attachments"] if a["type"] == "audio"
+                        ]
+                        missing.extend(
+                            (post["post_id"], audio)
+                            for i, audio in enumerate(audios)
+                            if not store.has(post["post_id"], "audios", i)
+                        )
+                    audio_urls = await resolve_audio_urls(
+                        missing, numeric_page_id, scraper, client
+                    )
+
+                await asyncio.gather(
+                    *(
+                        save_data(
+                            post,
+                            db,
+                            store,
+                            numeric_page_id,
+                            audio_urls,
+                            client,
+                            failures,
+                        )
+                        for post in posts
+                    )
+                )
+                failures.flush()
+        finally:
+            scraper.close()
+
+
+AUDIO_BYTES_PER_SECOND = 320_000 // 8
+# rough mp4 bitrates of VK video variants, bytes per second
+VIDEO_BYTES_PER_SECOND = {
+    240: 40_000,
+    360: 75_000,
+    480: 125_000,
+    720: 250_000,
+    1080: 500_000,
+}
+EXECUTE_CALLS = 25
+
+
+async def scan_wall(
+    client: AsyncVkClient, page_id: str, offsets: List[int]
+) -> List[List[List[Dict[str, Any]]]]:
+    """Attachments of the 100-post windows starting at `offsets`, read with
+    `execute` so one API call covers EXECUTE_CALLS windows"""
+    windows: List[List[List[Dict[str, Any]]]] = []
+    for i in range(0, len(offsets), EXECUTE_CALLS):
+        code = (
+            "var offsets = %s; var res = []; var i = 0;"
+            "while (i < offsets.length) {"
+            'res.push(API.wall.get({"domain": "%s", "count": 100, '
+            '"offset": offsets[i]}).items@.attachments);'
+            "i = i + 1; }"
+            "return res;"
+        ) % (json.dumps(offsets[i : i + EXECUTE_CALLS]), page_id)
+        for window in await client.execute(code):
+            windows.append([attachments or [] for attachments in window])
+
+    return windows
+
+
+def estimate_plan(
+    n_posts: int,
+    windows: List[List[List[Dict[str, Any]]]],
+    photo_sizes: List[int],
+    video_quality: int,
+    requests_per_second: float,
+    bandwidth: float,
+) -> Dict[str, Any]:
+    """Extrapolates scanned windows of the wall to the cost of exporting
+    `n_posts` of it; `bandwidth` is in bytes per second"""
+    scanned = sum(len(window) for window in windows)
+    scale = n_posts / scanned if scanned else 0.0
+
+    counts: Dict[str, int] = defaultdict(int)
+    audio_seconds = 0
+    video_seconds = 0
+    for window in windows:
+        for attachments in window:
+            for attachment in attachments:
+                kind = attachment["type"]
+                counts[kind] += 1
+                if kind == "audio":
+                    audio_seconds += attachment["audio"].get("duration", 0)
+                if kind == "video" and "platform" not in attachment["video"]:
+                    video_seconds += attachment["video"].get("duration", 0)
+
+    video_rates = [q for q in VIDEO_BYTES_PER_SECOND if q <= video_quality]
+    video_rate = VIDEO_BYTES_PER_SECOND[max(video_rates or [240])]
+    photo_size = sum(photo_sizes) / len(photo_sizes) if photo_sizes else 0
+    media_bytes = {
+        "photo": int(counts.get("photo", 0) * photo_size * scale),
+        "audio": int(audio_seconds * AUDIO_BYTES_PER_SECOND * scale),
+        "video": int(video_seconds * video_rate * scale),
+    }
+
+    n_batches = -(-n_posts // 100)
+    with_audio = sum(
+        any(a["type"] == "audio" for post in window for a in post) for window in windows
+    )
+    api_calls = (
+        2  # post count and screen name
+        + n_batches  # wall.get
+        + int(counts.get("video", 0) * scale)  # video.get per video
+        + int(n_batches * with_audio / len(windows) if windows else 0)  # audios
+    )
+    api_seconds = api_calls / requests_per_second
+    download_seconds = sum(media_bytes.values()) / bandwidth
+
+    return {
+        "posts": n_posts,
+        "scanned_posts": scanned,
+        "attachments": {kind: int(n * scale) for kind, n in sorted(counts.items())},
+        "bytes": media_bytes,
+        "api_calls": api_calls,
+        "api_seconds": int(api_seconds),
+        "download_seconds": int(download_seconds),
+        "seconds": int(api_seconds + download_seconds),
+    }
+
+
+def plan_offsets(n_posts: int, sample: int) -> List[int]:
+    """Offsets of the 100-post windows to scan, `sample` -1 covers every post"""
+    n_windows = -(-n_posts // 100)
+    if sample == -1 or -(-sample // 100) >= n_windows:
+        return list(range(0, n_posts, 100))
+
+    n_windows = -(-sample // 100)
+    return sorted({i * n_posts // n_windows // 100 * 100 for i in range(n_windows)})
+
+
+async def make_plan(
+    page_id: str,
+    n_posts: int,
+    sample: int,
+    head_sample: int,
+    video_quality: int,
+    bandwidth: float,
+    session: vk.VkApi,
+    requests_per_second: float = API_REQUESTS_PER_SECOND,
+) -> Dict[str, Any]:
+    async with AsyncVkClient.from_session(
+        session, requests_per_second=requests_per_second
+    ) as client:
+        total_posts = (await client.wall_get(domain=page_id, count=1))["count"]
+        n_posts = min(n_posts, total_posts) if n_posts != -1 else total_posts
+
+        offsets = plan_offsets(n_posts, sample)
+        windows = await scan_wall(client, page_id, offsets)
+
+        photo_urls = [
+            best_photo_url(attachment["photo"])
+            for window in windows
+            for attachments in window
+            for attachment in attachments
+            if attachment["type"] == "photo"
+        ]
+        photo_urls = random.sample(photo_urls, min(head_sample, len(photo_urls)))
+        sizes = await asyncio.gather(*(client.content_length(u) for u in photo_urls))
+
+        return estimate_plan(
+            n_posts,
+            windows,
+            [size for size in sizes if size is not None],
+            video_quality,
+            client.requests_per_second,
+            bandwidth,
+        )
+
+
+PROFILE_OPTION = typer.Option(False, "--profile", help="Save cProfile stats")
+TRACE_MEMORY_OPTION = typer.Option(
+    False, "--trace-memory", help="Save tracemalloc top allocators"
+)
+VIDEO_QUALITY_OPTION = typer.Option(
+    720, help="Highest video resolution to download, e.g. 480 or 1080"
+)
+MAX_INFLIGHT_MB_OPTION = typer.Option(
+    256, help="Budget of megabytes downloading at the same time"
+)
+MAX_DOWNLOADS_OPTION = typer.Option(64, help="Budget of concurrent media downloads")
+HOST_BANDWIDTH_MB_OPTION = typer.Option(
+    0.0, help="Bandwidth cap per media host in MB/s, 0 for unlimited"
+)
+REQUESTS_PER_SECOND_OPTION = typer.Option(
+    API_REQUESTS_PER_SECOND,
+    help="API calls per second, raise it for tokens with a higher quota",
+)
+
+
+def make_scheduler(
+    max_inflight_mb: int, max_downloads: int, host_bandwidth_mb: float
+) -> DownloadScheduler:
+    return DownloadScheduler(
+        max_bytes=max_inflight_mb << 20,
+        max_connections=max_downloads,
+        host_bandwidth=host_bandwidth_mb * (1 << 20),
+    )
+
+
 @app.command()
-def run(url: str, n_posts: int = -1) -> None:
+def run(
+    url: str,
+    n_posts: int = -1,
+    shards: int = typer.Option(1, help="Fetch the wall in N concurrent shards"),
+    connections: int = typer.Option(100, help="Size of the HTTP connection pool"),
+    storage: str = typer.Option(
+        None, help='Media layout: "dir" (file per item) or "pack" (segment files)'
+    ),
+    video_quality: int = VIDEO_QUALITY_OPTION,
+    max_inflight_mb: int = MAX_INFLIGHT_MB_OPTION,
+    max_downloads: int = MAX_DOWNLOADS_OPTION,
+    host_bandwidth_mb: float = HOST_BANDWIDTH_MB_OPTION,
+    requests_per_second: float = REQUESTS_PER_SECOND_OPTION,
+    profile: bool = PROFILE_OPTION,
+    trace_memory: bool = TRACE_MEMORY_OPTION,
+) -> None:
     """Run full set of actions: get posts, download media, rendering html"""
-    session, api = auth()
+    session, _ = auth()
     page_id = url_to_domain(url)
 
     init_working_directory(page_id)
     conn = initialize_table(page_id)
 
-    for batch in get_posts(page_id, n_posts, api):
-        for post in batch:
-            data = process_post_json(post, api)
-            save_data(data, conn, page_id, session)
-
-    render_html(conn)
+    store = open_store(page_id, storage)
+    with profiling(page_id, profile, trace_memory):
+        try:
+            asyncio.run(
+                export_posts(
+                    conn,
+                    page_id,
+                    n_posts,
+                    shards,
+                    store,
+                    session,
+                    connections,
+                    video_quality,
+                    make_scheduler(max_inflight_mb, max_downloads, host_bandwidth_mb),
+                    requests_per_second,
+                )
+            )
+        finally:
+            store.close()
+
+        render_html(conn)
 
     conn.close()
 
 
 @app.command()
-def get(url: str, n_posts: int = -1, db_path: str = "./cache.db") -> None:
+def get(
+    url: str,
+    n_posts: int = -1,
+    db_path: Optional[str] = typer.Option(
+        None, help="Where to store posts, cache/<page>/posts.db by default"
+    ),
+    requests_per_second: float = REQUESTS_PER_SECOND_OPTION,
+    profile: bool = PROFILE_OPTION,
+    trace_memory: bool = TRACE_MEMORY_OPTION,
+) -> None:
     """Download data only (no files)"""
-    pass
+    session, _ = auth()
+    page_id = url_to_domain(url)
+
+    init_working_directory(page_id)
+    conn = initialize_table(page_id, db_path)
+
+    with profiling(page_id, profile, trace_memory):
+        asyncio.run(
+            export_posts(
+                conn,
+                page_id,
+                n_posts,
+                1,
+                None,
+                session,
+                100,
+                requests_per_second=requests_per_second,
+            )
+        )
+
+    conn.close()
+
+
+async def retry_failures(
+    page_id: str,
+    failures: FailureQueue,
+    store: MediaStore,
+    session: vk.VkApi,
+    connections: int,
+    max_attempts: int,
+    video_quality: int,
+    scheduler: Optional[DownloadScheduler] = None,
+) -> Tuple[int, int]:
+    """Downloads queued media again from fresh URLs, returns (fixed, total)"""
+    pending = failures.pending(max_attempts)
+    fixed = 0
+
+    async with AsyncVkClient.from_session(
+        session, connections=connections, scheduler=scheduler
+    ) as client:
+        numeric_page_id = await client.resolve_screen_name(page_id)
+        scraper = AudioScraper(session)
+        try:
+            for i in range(0, len(pending), 500):
+                chunk = pending[i : i + 500]
+                photo_urls = await resolve_photo_urls(
+                    [obj for _, kind, _, obj in chunk if kind == "photos"], client
+                )
+                audio_urls = await resolve_audio_urls(
+                    [
+                        (post_id, obj)
+                        for post_id, kind, _, obj in chunk
+                        if kind == "audios"
+                    ],
+                    numeric_page_id,
+                    scraper,
+                    client,
+                )
+                video_urls = await resolve_video_urls(
+                    [obj for _, kind, _, obj in chunk if kind == "videos"],
+                    client,
+                    video_quality,
+                )
+                urls = {
+                    "photos": photo_urls,
+                    "audios": audio_urls,
+                    "videos": video_urls,
+                }
+
+                results = await asyncio.gather(
+                    *(
+                        save_media(
+                            kind,
+                            idx,
+                            obj,
+                            urls[kind].get((obj["owner_id"], obj["id"])),
+                            store,
+                            post_id,
+                            client,
+                            failures,
+                        )
+                        for post_id, kind, idx, obj in chunk
+                    )
+                )
+                fixed += sum(results)
+                failures.flush()
+        finally:
+            scraper.close()
+
+    return fixed, len(pending)
+
+
+@app.command()
+def retry(
+    url: str,
+    connections: int = typer.Option(100, help="Size of the HTTP connection pool"),
+    max_attempts: int = typer.Option(
+        -1, help="Skip items that already failed this many times"
+    ),
+    video_quality: int = VIDEO_QUALITY_OPTION,
+    max_inflight_mb: int = MAX_INFLIGHT_MB_OPTION,
+    max_downloads: int = MAX_DOWNLOADS_OPTION,
+    host_bandwidth_mb: float = HOST_BANDWIDTH_MB_OPTION,
+) -> None:
+    """Download media that failed during previous runs"""
+    page_id = url_to_domain(url)
+    db_path = f"cache/{page_id}/posts.db"
+    if not pathlib.Path(db_path).exists():
+        llog.err("There is no data associated with this URL")
+        return
+
+    session, _ = auth()
+    db = sqlite3.connect(db_path)
+    failures = FailureQueue(db)
+    store = open_store(page_id)
+    try:
+        fixed, total = asyncio.run(
+            retry_failures(
+                page_id,
+                failures,
+                store,
+                session,
+                connections,
+                max_attempts,
+                video_quality,
+                make_scheduler(max_inflight_mb, max_downloads, host_bandwidth_mb),
+            )
+        )
+    finally:
+        store.close()
+        db.close()
+
+    if fixed == total:
+        llog.success(f"Downloaded {fixed} queued media files")
+    else:
+        llog.err(f"Downloaded {fixed} of {total} queued media files")
+
+
+@app.command()
+def plan(
+    url: str,
+    n_posts: int = -1,
+    sample: int = typer.Option(
+        2000, help="Posts to scan, spread over the wall; -1 scans all of it"
+    ),
+    head_sample: int = typer.Option(200, help="Photos to HEAD for their size"),
+    video_quality: int = VIDEO_QUALITY_OPTION,
+    bandwidth_mb: float = typer.Option(10.0, help="Expected download MB/s"),
+    requests_per_second: float = REQUESTS_PER_SECOND_OPTION,
+) -> None:
+    """Estimate posts, media, API calls and time a run would take"""
+    session, _ = auth()
+    page_id = url_to_domain(url)
+
+    estimate = asyncio.run(
+        make_plan(
+            page_id,
+            n_posts,
+            sample,
+            head_sample,
+            video_quality,
+            bandwidth_mb * (1 << 20),
+            session,
+            requests_per_second,
+        )
+    )
+
+    llog.info(f"Posts: {estimate['posts']} ({estimate['scanned_posts']} scanned)")
+    for kind, count in estimate["attachments"].items():
+        llog.info(f"Attachments of type {kind}: {count}")
+    for kind, size in estimate["bytes"].items():
+        llog.info(f"Media bytes of type {kind}: {size / (1 << 20):.1f} MB")
+    llog.info(f"API calls: {estimate['api_calls']}")
+    llog.info(
+        f"Time: {estimate['seconds']} s at most "
+        f"({estimate['api_seconds']} s API, {estimate['download_seconds']} s media)"
+    )
+
+    pathlib.Path("cache", page_id).mkdir(parents=True, exist_ok=True)
+    with open(pathlib.Path("cache", page_id, "plan.json"), "w") as f:
+        json.dump(estimate, f, indent=2)
+    llog.success(f"Plan saved to cache/{page_id}/plan.json")
 
 
 @app.command()
@@ -405,6 +2410,7 @@ def clean(url: str, full: bool = typer.Option(False, "-f")) -> None:
     c = db.cursor()
     sql_drop_table = "DROP TABLE IF EXISTS posts"
     c.execute(sql_drop_table)
+    c.execute("DROP TABLE IF EXISTS failures")
     db.commit()
 
     llog.success("Dropped posts database")
@@ -415,15 +2421,147 @@ def clean(url: str, full: bool = typer.Option(False, "-f")) -> None:
 
 
 @app.command()
-def render(url: str) -> None:
+def pack(
+    url: str,
+    remove: bool = typer.Option(False, help="Delete per-file media once packed"),
+) -> None:
+    """Convert the per-file media cache into pack segments"""
+    page_id = url_to_domain(url)
+    if not pathlib.Path("cache", page_id).exists():
+        llog.err("There is no data associated with this URL")
+        return
+
+    source = DirectoryStore(page_id)
+    target = PackStore(page_id)
+
+    n_items = 0
+    try:
+        for post_id, kind, idx in source.keys():
+            if target.has(post_id, kind, idx):
+                continue
+            target.put_file(post_id, kind, idx, source.path(post_id, kind, idx))
+            n_items += 1
+    finally:
+        target.close()
+
+    llog.success(f"Packed {n_items} media files")
+
+    if remove:
+        for kind in MEDIA_TYPES:
+            shutil.rmtree(source.root / kind, ignore_errors=True)
+        llog.success("Deleted per-file media")
+
+
+@app.command()
+def archive(
+    url: str,
+    output: str = typer.Option(None, help="Archive path, <page>.vkarc by default"),
+    workers: int = typer.Option(os.cpu_count() or 1, help="Compression threads"),
+) -> None:
+    """Pack the page cache (database, media, wikis) into one archive file"""
+    page_id = url_to_domain(url)
+    if not pathlib.Path("cache", page_id).exists():
+        llog.err("There is no data associated with this URL")
+        return
+
+    output = output or f"{page_id}.vkarc"
+    writer = ArchiveWriter(output, page_id, workers)
+    try:
+        writer.add_files(cache_files(page_id))
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+    llog.success(f"Archived {len(writer.members)} files into {output}")
+
+
+@app.command("import")
+def import_archive(
+    path: str,
+    posts: List[int] = typer.Option([], "--post", help="Only media of these posts"),
+    kinds: List[str] = typer.Option([], "--kind", help="Only these media types"),
+    with_db: bool = typer.Option(
+        False, "--db", help="Also restore posts.db when selecting media"
+    ),
+) -> None:
+    """Restore a page cache from an archive, optionally only selected media"""
+    reader = ArchiveReader(path)
+    root = pathlib.Path("cache", reader.page_id)
+
+    def selected(post_id: int, kind: str) -> bool:
+        return (not posts or post_id in posts) and (not kinds or kind in kinds)
+
+    try:
+        if not posts and not kinds:
+            for name in reader.members:
+                reader.extract(name, root / name)
+            llog.success(f"Restored {len(reader.members)} files of {reader.page_id}")
+            return
+
+        # selected items go into whatever store the local cache already uses
+        store = open_store(reader.page_id)
+        try:
+            n_items = 0
+            for name in reader.members:
+                parts = name.split("/")
+                if (
+                    len(parts) == 3
+                    and parts[0] in MEDIA_TYPES
+                    and parts[1].isdigit()
+                    and parts[2].isdigit()
+                ):
+                    kind, post_id, idx = parts[0], int(parts[1]), int(parts[2])
+                    if selected(post_id, kind):
+                        with store.writer(post_id, kind, idx) as out:
+                            reader.copy(name, out)
+                        n_items += 1
+                elif name == "posts.db" and with_db:
+                    reader.extract(name, root / name)
+
+            if "pack/index.db" in reader.members:
+                # pick single items out of the packed segments without unpacking them
+                with tempfile.TemporaryDirectory() as tmp:
+                    index_path = pathlib.Path(tmp, "index.db")
+                    reader.extract("pack/index.db", index_path)
+                    index = sqlite3.connect(str(index_path))
+                    rows = index.execute("SELECT * FROM pack_index").fetchall()
+                    index.close()
+
+                for post_id, kind, idx, segment, offset, length in rows:
+                    if selected(post_id, kind):
+                        segment_name = f"pack/segment-{segment:05}.pack"
+                        with store.writer(post_id, kind, idx) as out:
+                            reader.copy(segment_name, out, offset, length)
+                        n_items += 1
+        finally:
+            store.close()
+    finally:
+        reader.close()
+
+    llog.success(f"Restored {n_items} media files of {reader.page_id}")
+
+
+@app.command()
+def render(
+    url: str,
+    profile: bool = PROFILE_OPTION,
+    trace_memory: bool = TRACE_MEMORY_OPTION,
+) -> None:
     """Render HTML with data from DB"""
-    db_path = f"cache/{url_to_domain(url)}/posts.db"
+    page_id = url_to_domain(url)
+    db_path = f"cache/{page_id}/posts.db"
     if not pathlib.Path(db_path).exists():
         llog.err("There is no data associated with this URL")
         return
 
     llog.info("Rendering {url}")
 
+    db = sqlite3.connect(db_path)
+    with profiling(page_id, profile, trace_memory):
+        render_html(db)
+    db.close()
+
 
 if __name__ == "__main__":
     app()